@@ -36,6 +36,8 @@ def main() -> None:
     parser.add_argument('-p', '--period', default=5, type=int, help='Persistence period, in seconds')
     parser.add_argument('-t', '--top-limit', default=5, type=int, help='Limit for top-n queries')
     parser.add_argument('--days', default=30, type=int, help='Default number of days in plots')
+    parser.add_argument('--threads', type=int, help='Number of DuckDB threads (default: all CPUs)')
+    parser.add_argument('--memory-limit', help='DuckDB memory limit, e.g., 1GB')
     args = parser.parse_args()
 
     logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG)
@@ -45,7 +47,7 @@ def main() -> None:
     else:
         connection = duckdb.connect(str(Path(args.database).resolve()))
 
-    dao = DAO(connection)
+    dao = DAO(connection, threads=args.threads, memory_limit=args.memory_limit)
 
     geoip = geolite2.reader()
 
@@ -95,6 +97,7 @@ def main() -> None:
         try:
             ballcone.persist()
         finally:
+            dao.close()
             connection.close()
 
 
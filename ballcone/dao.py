@@ -1,15 +1,22 @@
 __author__ = 'Dmitry Ustalov'
 
 import logging
-from contextlib import contextmanager
-from datetime import datetime, date
+import os
+import threading
+from contextlib import contextmanager, suppress
+from datetime import datetime, date, time, timedelta
+from functools import lru_cache
 from ipaddress import ip_address, IPv4Address, IPv6Address
-from typing import Generator, NamedTuple, Optional, List, Sequence, Union, Any, NewType, Tuple, Deque, Set, cast
+from typing import TYPE_CHECKING, Callable, Generator, NamedTuple, Optional, List, Sequence, Union, Any, NewType, Tuple, Deque, Dict, cast
 
 import duckdb
-import pypika.enums
-from pypika import Query, Column, Field, Parameter, Table, Order, functions as fn, analytics as an
-from pypika.queries import QueryBuilder
+
+if TYPE_CHECKING:
+    from pypika.queries import QueryBuilder
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 10_000
 
 smallint = NewType('smallint', int)
 
@@ -25,29 +32,32 @@ TYPES = {
 }
 
 
+cached_ip_address = lru_cache(maxsize=65536)(ip_address)
+
+
 def is_empty(obj: Any) -> bool:
-    if hasattr(obj, '__len__'):
-        return not len(obj)
+    if obj is None:
+        return True
 
-    return obj is None
+    length = getattr(type(obj), '__len__', None)
 
+    return length is not None and not length(obj)
 
-def optional_types(annotation: Any) -> Tuple[Set[Any], bool]:
-    if hasattr(annotation, '__args__'):
-        types = set(annotation.__args__)
-        null = type(None) in types
 
-        if null:
-            types.remove(type(None))
+@lru_cache(maxsize=64)
+def optional_types(annotation: Any) -> Tuple[Tuple[Any, ...], bool]:
+    if hasattr(annotation, '__args__'):
+        types = tuple(arg for arg in annotation.__args__ if arg is not type(None))
 
-        return types, null
+        return types, len(types) < len(annotation.__args__)
     else:
-        return {annotation}, False
+        return (annotation,), False
 
 
+@lru_cache(maxsize=64)
 def python_type_to_sql(annotation: Any) -> str:
     types, null = optional_types(annotation)
-    first_type = next(iter(types))
+    first_type = types[0]
 
     if null:
         return TYPES[first_type]
@@ -55,20 +65,55 @@ def python_type_to_sql(annotation: Any) -> str:
         return TYPES[first_type] + ' NOT NULL'
 
 
-def sql_value_to_python(name: str, annotation: Any, value: Any) -> Any:
+def identity(value: Any) -> Any:
+    return value
+
+
+def none_if_empty(value: Any) -> Any:
+    return None if is_empty(value) else value
+
+
+@lru_cache(maxsize=64)
+def sql_to_python_converter(annotation: Any) -> Callable[[Any], Any]:
     args, null = optional_types(annotation)
-    first_type = next(iter(args))
+    first_type = args[0]
 
     if first_type == datetime:
-        return value
+        return identity
 
     if first_type == smallint:
-        return int(value)
+        return int
 
     if first_type in (IPv4Address, IPv6Address):
-        return ip_address(value)
+        return cached_ip_address
+
+    if null:
+        return lambda value: None if is_empty(value) else first_type(value)
+
+    return cast(Callable[[Any], Any], first_type)
+
 
-    return None if is_empty(value) and null else first_type(value)
+def sql_column_converter(annotation: Any) -> Callable[[Any], Any]:
+    args, null = optional_types(annotation)
+
+    # DuckDB already returns these as Python objects of the right type
+    if not null and all(arg in (datetime, str, smallint, int, float, bool) for arg in args):
+        return identity
+
+    return sql_to_python_converter(annotation)
+
+
+def python_to_sql_converter(annotation: Any) -> Callable[[Any], Any]:
+    args, null = optional_types(annotation)
+
+    if any(arg in (IPv4Address, IPv6Address) for arg in args):
+        return str
+
+    return none_if_empty if null else identity
+
+
+def sql_value_to_python(name: str, annotation: Any, value: Any) -> Any:
+    return sql_to_python_converter(annotation)(value)
 
 
 class Entry(NamedTuple):
@@ -91,24 +136,19 @@ class Entry(NamedTuple):
 
     @staticmethod
     def from_values(entry: Sequence[Any]) -> 'Entry':
-        return Entry(*(sql_value_to_python(name, annotation, value)
-                       for (name, annotation), value in zip(Entry.__annotations__.items(), entry)))
+        return Entry(*(convert(value) for convert, value in zip(FROM_VALUES_CONVERTERS, entry)))
 
-    @staticmethod
-    def as_value(value: Any, annotation: Any = None) -> Any:
-        if isinstance(value, (IPv4Address, IPv6Address)):
-            return str(value)
+    def as_values(self) -> Sequence[Any]:
+        return tuple(convert(value) for convert, value in zip(AS_VALUES_CONVERTERS, self))
 
-        if annotation:
-            _, null = optional_types(annotation)
 
-            return None if is_empty(value) and null else value
-        else:
-            return value
+ENTRY_FIELDS: Tuple[Tuple[str, Any], ...] = tuple(Entry.__annotations__.items())
 
-    def as_values(self) -> Sequence[Any]:
-        return tuple(self.as_value(getattr(self, name), annotation)
-                     for name, annotation in self.__annotations__.items())
+FROM_VALUES_CONVERTERS = tuple(sql_to_python_converter(annotation) for _, annotation in ENTRY_FIELDS)
+
+AS_VALUES_CONVERTERS = tuple(python_to_sql_converter(annotation) for _, annotation in ENTRY_FIELDS)
+
+COLUMN_CONVERTERS = tuple(sql_column_converter(annotation) for _, annotation in ENTRY_FIELDS)
 
 
 class Count(NamedTuple):
@@ -139,66 +179,171 @@ class AverageResult(NamedTuple):
     elements: List[Average]
 
 
+SQL_TABLES = '''
+SELECT DISTINCT table_name FROM information_schema.tables
+WHERE table_schema = 'main' AND table_type = 'BASE TABLE'
+ORDER BY table_name
+'''
+
+SQL_TABLE_EXISTS = '''
+SELECT 1 FROM information_schema.tables
+WHERE table_schema = 'main' AND table_type = 'BASE TABLE' AND table_name = ?
+LIMIT 1
+'''
+
+SQL_DATE = 'CAST("datetime" AS DATE)'
+
+SQL_SELECT = 'SELECT * FROM {table}{where} ORDER BY "datetime"{limit}'
+
+SQL_SELECT_AVERAGE = f'''
+SELECT {SQL_DATE} AS "date", CAST(AVG({{field}}) AS DOUBLE) AS "average",
+       CAST(COALESCE(SUM({{field}}), 0) AS DOUBLE) AS "sum", COUNT({{field}}) AS "count"
+FROM {{table}}{{where}}
+GROUP BY "date"
+ORDER BY "date"
+'''
+
+SQL_SELECT_COUNT = f'''
+SELECT {SQL_DATE} AS "date", CAST(NULL AS VARCHAR) AS "group", COUNT({{count}}) AS "count"
+FROM {{table}}{{where}}
+GROUP BY "date"
+ORDER BY "date"
+'''
+
+SQL_SELECT_COUNT_GROUP = f'''
+WITH grouped AS (
+    SELECT {SQL_DATE} AS "date", {{group}} AS "group", COUNT({{count}}) AS "count"
+    FROM {{table}}{{where}}
+    GROUP BY "date", {{group}}
+){{ranked}}
+SELECT "date", "group", "count"
+FROM {{source}}
+ORDER BY "date", "count" {{order}}, "group"
+'''
+
+SQL_COUNT_GROUP_RANKED = ''', ranked AS (
+    SELECT *, ROW_NUMBER() OVER (PARTITION BY "date" ORDER BY "count" {order}, "group") AS "row_number"
+    FROM grouped
+)'''
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_field(field: str) -> str:
+    if field not in Entry._fields:
+        raise ValueError(f'Unknown field: {field}')
+
+    return quote_identifier(field)
+
+
+def dates_range(start: Optional[date] = None,
+                stop: Optional[date] = None) -> Tuple[Optional[datetime], Optional[datetime]]:
+    # Compare the raw timestamps so that DuckDB can skip row groups by their min/max values
+    since = datetime.combine(start, time.min) if start else None
+    # Every timestamp falls on or before date.max, and the day after it would overflow
+    until = datetime.combine(stop, time.min) + timedelta(days=1) if stop and stop != date.max else None
+
+    return since, until
+
+
+def dates_where(start: Optional[date] = None, stop: Optional[date] = None) -> Tuple[str, List[Any]]:
+    since, until = dates_range(start, stop)
+
+    clauses, parameters = [], []
+
+    if since:
+        clauses.append('"datetime" >= ?')
+        parameters.append(since)
+
+    if until:
+        clauses.append('"datetime" < ?')
+        parameters.append(until)
+
+    return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), parameters
+
+
 class DAO:
-    def __init__(self, db: duckdb.DuckDBPyConnection) -> None:
+    def __init__(self, db: duckdb.DuckDBPyConnection, preserve_order: bool = False,
+                 threads: Optional[int] = None, memory_limit: Optional[str] = None) -> None:
         self.db = db
-        self.placeholders = [Parameter('?') for _ in Entry._fields]
+        self._local = threading.local()
+        self._cursors: List[duckdb.DuckDBPyConnection] = []
+        self.configure(preserve_order, threads, memory_limit)
+        self._insert_sql_cache: Dict[str, str] = {}
 
-    def size(self) -> int:
-        return cast(int, self.run('SELECT COALESCE(total_blocks * block_size, 0) FROM pragma_database_size()')[0][0])
+    def configure(self, preserve_order: bool = False, threads: Optional[int] = None,
+                  memory_limit: Optional[str] = None) -> None:
+        settings = [f'SET preserve_insertion_order = {str(preserve_order).lower()}']
 
-    def tables(self) -> Sequence[str]:
-        master = Table('sqlite_master')
-        query = Query.from_('sqlite_master').select(master.name). \
-            where(master.type == 'table').distinct(). \
-            orderby(master.name)
+        threads = threads or os.cpu_count()
 
-        sql = str(query)
+        if threads:
+            settings.append(f'SET threads = {int(threads)}')
 
-        logging.debug(sql)
+        if memory_limit:
+            settings.append("SET memory_limit = '{}'".format(memory_limit.replace("'", "''")))
 
-        return [table for table, *_ in self.run(query)]
+        for sql in settings:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('%s', sql)
 
-    def table_exists(self, table: str) -> bool:
-        master = Table('sqlite_master')
+            self.db.execute(sql)
 
-        query = Query.from_(master).select(master.name). \
-            where((master.type == 'table') & (master.name == table))
-
-        sql = str(query)
+    def size(self) -> int:
+        return cast(int, self._query('SELECT COALESCE(total_blocks * block_size, 0) FROM pragma_database_size()')[0][0])
 
-        logging.debug(sql)
+    def tables(self) -> Sequence[str]:
+        return [table for table, *_ in self._query(SQL_TABLES)]
 
-        return len(self.run(query)) > 0
+    def table_exists(self, table: str) -> bool:
+        return len(self._query(SQL_TABLE_EXISTS, (table,))) > 0
 
     def create_table(self, table: str) -> int:
+        from pypika import Query, Column, Table
+
         target = Table(table)
 
-        columns = [Column(name, python_type_to_sql(annotation)) for name, annotation in Entry.__annotations__.items()]
+        columns = [Column(name, python_type_to_sql(annotation)) for name, annotation in ENTRY_FIELDS]
 
         query = Query.create_table(target).columns(*columns)
         sql = str(query)
 
-        logging.debug(sql)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s', sql)
 
         with self.transaction() as cursor:
             return cast(int, cursor.execute(sql))
 
     def drop_table(self, table: str) -> int:
+        from pypika import Query
+
         sql = str(Query.drop_table(table))
 
-        logging.debug(sql)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s', sql)
 
         with self.transaction() as cursor:
             return cast(int, cursor.execute(sql))
 
-    def insert_into(self, table: str, entry: Entry, cursor: Optional[duckdb.DuckDBPyConnection] = None) -> None:
-        target = Table(table)
+    def _insert_sql(self, table: str) -> str:
+        sql = self._insert_sql_cache.get(table)
+
+        if sql is None:
+            from pypika import Query, Parameter, Table
+
+            placeholders = [Parameter('?') for _ in Entry._fields]
 
-        query = Query.into(target).insert(*self.placeholders)
-        sql, values = str(query), entry.as_values()
+            sql = self._insert_sql_cache[table] = str(Query.into(Table(table)).insert(*placeholders))
 
-        logging.debug(sql + ' -- ' + str(values))
+        return sql
+
+    def insert_into(self, table: str, entry: Entry, cursor: Optional[duckdb.DuckDBPyConnection] = None) -> None:
+        sql, values = self._insert_sql(table), entry.as_values()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s -- %s', sql, values)
 
         if cursor:
             cursor.execute(sql, values)
@@ -206,182 +351,200 @@ class DAO:
             with self.transaction() as cursor:
                 cursor.execute(sql, values)
 
-    def batch_insert_into(self, table: str, entries: Sequence[Entry]) -> int:
+    def batch_append(self, table: str, entries: Sequence[Entry], chunk_size: int = CHUNK_SIZE) -> int:
         if not entries:
             return 0
 
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('APPEND %d entries INTO "%s"', len(entries), table)
+
+        import pandas as pd
+
         with self.transaction() as cursor:
-            count = 0
+            for i in range(0, len(entries), chunk_size):
+                frame = pd.DataFrame([entry.as_values() for entry in entries[i:i + chunk_size]],
+                                     columns=Entry._fields)
+
+                cursor.append(table, frame)
 
-            for entry in entries:
-                self.insert_into(table, entry, cursor=cursor)
-                count += 1
+        return len(entries)
 
-            return count
+    def batch_insert_into(self, table: str, entries: Sequence[Entry],
+                          cursor: Optional[duckdb.DuckDBPyConnection] = None, chunk_size: int = CHUNK_SIZE) -> int:
+        if cursor is None:
+            return self.batch_append(table, entries, chunk_size=chunk_size)
 
-    def batch_insert_into_from_deque(self, table: str, entries: Deque[Entry]) -> int:
         if not entries:
             return 0
 
-        with self.transaction() as cursor:
-            count = 0
+        sql = self._insert_sql(table)
 
-            while entries:
-                entry = entries.popleft()
-                self.insert_into(table, entry, cursor=cursor)
-                count += 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s -- %d rows', sql, len(entries))
 
-            return count
+        for i in range(0, len(entries), chunk_size):
+            cursor.executemany(sql, [entry.as_values() for entry in entries[i:i + chunk_size]])
 
-    def select(self, table: str, start: Optional[date] = None, stop: Optional[date] = None,
-               limit: Optional[int] = None) -> List[Entry]:
-        target = Table(table)
-
-        query = Query.from_(target).select('*').orderby(target.datetime).limit(limit)
-
-        query = self.apply_dates(query, target, start, stop)
+        return len(entries)
 
-        rows = cast(List[Union[List[Any], Entry]], self.run(query))
+    def batch_insert_into_from_deque(self, table: str, entries: Deque[Entry],
+                                     cursor: Optional[duckdb.DuckDBPyConnection] = None,
+                                     chunk_size: int = CHUNK_SIZE) -> int:
+        batch = list(entries)
 
-        for i, current in enumerate(rows):
-            rows[i] = Entry.from_values(cast(List[Any], current))
+        count = self.batch_insert_into(table, batch, cursor=cursor, chunk_size=chunk_size)
 
-        return cast(List[Entry], rows)
+        # Keep the queue intact if the insert failed, so the next flush retries it
+        entries.clear()
 
-    def select_average(self, table: str, field: str, start: Optional[date] = None,
-                       stop: Optional[date] = None) -> AverageResult:
-        target = Table(table)
-        target_field = Field(field, table=target)
-        date = fn.Cast(target.datetime, pypika.enums.SqlTypes.DATE, alias='date')
+        return count
 
-        query = Query.from_(target).select(date,
-                                           fn.Avg(target_field, alias='average'),
-                                           fn.Sum(target_field, alias='sum'),
-                                           fn.Count(target_field, alias='count')). \
-            groupby(date).orderby(target.date)
+    def select(self, table: str, start: Optional[date] = None, stop: Optional[date] = None,
+               limit: Optional[int] = None) -> List[Entry]:
+        where, parameters = dates_where(start, stop)
 
-        query = self.apply_dates(query, target, start, stop)
+        if limit is not None:
+            parameters.append(limit)
 
-        result = AverageResult(table=table, field=field, elements=[])
+        sql = SQL_SELECT.format(table=quote_identifier(table), where=where,
+                                limit='' if limit is None else ' LIMIT ?')
 
-        for current in self.run(query):
-            result.elements.append(Average(
-                date=current[0],
-                avg=float(current[1]),
-                sum=float(current[2]) if current[3] else 0.,
-                count=int(current[3])
-            ))
+        rows = self._query(sql, parameters)
 
-        return result
+        if not rows:
+            return []
 
-    def select_count(self, table: str, field: Optional[str] = None, start: Optional[date] = None,
-                     stop: Optional[date] = None) -> CountResult:
-        target = Table(table)
-        date = fn.Cast(target.datetime, pypika.enums.SqlTypes.DATE, alias='date')
+        columns = [column if convert is identity else list(map(convert, column))
+                   for convert, column in zip(COLUMN_CONVERTERS, zip(*rows))]
 
-        count_field = fn.Count(Field(field, table=target) if field else date, alias='count')
+        return list(map(Entry._make, zip(*columns)))
 
-        if field:
-            count_field = count_field.distinct()
+    def select_average(self, table: str, field: str, start: Optional[date] = None,
+                       stop: Optional[date] = None) -> AverageResult:
+        where, parameters = dates_where(start, stop)
 
-        query = Query.from_(target).select(date, count_field).groupby(date).orderby(date)
+        sql = SQL_SELECT_AVERAGE.format(table=quote_identifier(table), field=quote_field(field), where=where)
 
-        query = self.apply_dates(query, target, start, stop)
+        return AverageResult(table=table, field=field, elements=list(map(Average._make, self._query(sql, parameters))))
 
-        result = CountResult(table=table, field=field, distinct=field is not None, group=None, ascending=None,
-                             elements=[])
+    def select_count(self, table: str, field: Optional[str] = None, start: Optional[date] = None,
+                     stop: Optional[date] = None) -> CountResult:
+        where, parameters = dates_where(start, stop)
 
-        for current in self.run(query):
-            result.elements.append(Count(
-                date=current[0],
-                group=None,
-                count=int(current[1])
-            ))
+        sql = SQL_SELECT_COUNT.format(table=quote_identifier(table), where=where,
+                                      count=f'DISTINCT {quote_field(field)}' if field else SQL_DATE)
 
-        return result
+        return CountResult(table=table, field=field, distinct=field is not None, group=None, ascending=None,
+                           elements=list(map(Count._make, self._query(sql, parameters))))
 
     def select_count_group(self, table: str, field: Optional[str], group: str, distinct: bool = False,
                            start: Optional[date] = None, stop: Optional[date] = None,
                            ascending: bool = True, limit: Optional[int] = None) -> CountResult:
-        target = Table(table)
-        date = fn.Cast(target.datetime, pypika.enums.SqlTypes.DATE, alias='date')
+        where, parameters = dates_where(start, stop)
 
-        count_field = fn.Count(Field(field, table=target) if field else date, alias='count')
-        order = Order.asc if ascending else Order.desc
+        count = quote_field(field) if field else SQL_DATE
 
         if distinct:
-            count_field = count_field.distinct()
+            count = f'DISTINCT {count}'
 
-        group_field = Field(group, table=target)
+        order = 'ASC' if ascending else 'DESC'
 
-        query = Query.from_(target).select(date, group_field.as_('group'), count_field). \
-            groupby(date, group_field).orderby(date). \
-            orderby(count_field, order=order).orderby(group_field)
+        # The window is only needed to keep the top-n groups per date
+        if limit is None:
+            ranked, source = '', 'grouped'
+        else:
+            ranked, source = SQL_COUNT_GROUP_RANKED.format(order=order), 'ranked WHERE "row_number" <= ?'
+            parameters.append(limit)
 
-        query = self.apply_dates(query, target, start, stop)
+        sql = SQL_SELECT_COUNT_GROUP.format(table=quote_identifier(table), group=quote_field(group), count=count,
+                                            where=where, order=order, ranked=ranked, source=source)
 
-        if limit is not None:
-            window = Query.from_(query).select(query.date, query.group, query.count,
-                                               an.RowNumber(alias='row_number').over(query.date).
-                                               orderby(query.count, order=order).orderby(query.group))
+        return CountResult(table=table, field=field, distinct=distinct, group=group, ascending=ascending,
+                           elements=list(map(Count._make, self._query(sql, parameters))))
 
-            query = Query.from_(window).select(window.date, window.group, window.count). \
-                where(window.row_number <= limit).orderby(window.date). \
-                orderby(window.count, order=order).orderby(window.group)
+    def run(self, query: Union['QueryBuilder', str], parameters: Optional[Sequence[Any]] = None) -> List[List[Any]]:
+        sql = str(query)
 
-        result = CountResult(table=table, field=field, distinct=distinct, group=group, ascending=ascending,
-                             elements=[])
+        if logger.isEnabledFor(logging.DEBUG):
+            if parameters:
+                logger.debug('%s -- %s', sql, parameters)
+            else:
+                logger.debug('%s', sql)
 
-        for current in self.run(query):
-            result.elements.append(Count(
-                date=current[0],
-                group=current[1],
-                count=int(current[2])
-            ))
+        # Arbitrary SQL may change session settings, so it never touches the shared cursor
+        cursor = self.db.cursor()
 
-        return result
+        try:
+            cursor.begin()
+            cursor.execute(sql, parameters)
 
-    def run(self, query: Union[QueryBuilder, str]) -> List[List[Any]]:
-        sql = str(query) if isinstance(query, QueryBuilder) else query
+            return cast(List[List[Any]], cursor.fetchall())
+        finally:
+            cursor.close()
 
-        logging.debug(sql)
+    def _query(self, sql: str, parameters: Optional[Sequence[Any]] = None) -> List[List[Any]]:
+        if logger.isEnabledFor(logging.DEBUG):
+            if parameters:
+                logger.debug('%s -- %s', sql, parameters)
+            else:
+                logger.debug('%s', sql)
 
         with self.cursor() as cursor:
-            cursor.execute(sql)
+            cursor.execute(sql, parameters)
 
             return cast(List[List[Any]], cursor.fetchall())
 
-    @staticmethod
-    def apply_dates(query: QueryBuilder, target: Table,
-                    start: Optional[date] = None, stop: Optional[date] = None) -> QueryBuilder:
-        date = fn.Cast(target.datetime, pypika.enums.SqlTypes.DATE, alias='date')
+    def _shared_cursor(self) -> duckdb.DuckDBPyConnection:
+        cursor: Optional[duckdb.DuckDBPyConnection] = getattr(self._local, 'cursor', None)
 
-        if start and stop:
-            if start == stop:
-                return query.where(date == Entry.as_value(start))
-            else:
-                return query.where(date[Entry.as_value(start):Entry.as_value(stop)])
-        elif start:
-            return query.where(date >= Entry.as_value(start))
-        elif stop:
-            return query.where(date <= Entry.as_value(stop))
+        if cursor is None:
+            cursor = self._local.cursor = self.db.cursor()
+            self._cursors.append(cursor)
 
-        return query
+        return cursor
+
+    def close(self) -> None:
+        for cursor in self._cursors:
+            cursor.close()
+
+        self._cursors.clear()
+        self._local = threading.local()
 
     @contextmanager
-    def cursor(self) -> Generator[duckdb.DuckDBPyConnection, None, None]:
-        cursor = self.db.cursor()
+    def _begin(self) -> Generator[duckdb.DuckDBPyConnection, None, None]:
+        # A call nested in an open cursor() or transaction() on this thread gets its own cursor, as before
+        nested = getattr(self._local, 'active', False)
+
+        cursor = self.db.cursor() if nested else self._shared_cursor()
+        cursor.begin()
+
+        self._local.active = True
 
         try:
-            cursor.begin()
             yield cursor
-        except RuntimeError as e:
-            raise e
         finally:
-            cursor.close()
+            if nested:
+                cursor.close()
+            else:
+                self._local.active = False
+
+    @contextmanager
+    def cursor(self) -> Generator[duckdb.DuckDBPyConnection, None, None]:
+        with self._begin() as cursor:
+            try:
+                yield cursor
+            finally:
+                with suppress(duckdb.TransactionException):
+                    cursor.rollback()
 
     @contextmanager
     def transaction(self) -> Generator[duckdb.DuckDBPyConnection, None, None]:
-        with self.cursor() as cursor:
-            yield cursor
-            cursor.commit()
+        with self._begin() as cursor:
+            try:
+                yield cursor
+                cursor.commit()
+            except BaseException:
+                with suppress(duckdb.TransactionException):
+                    cursor.rollback()
+
+                raise
@@ -1,6 +1,6 @@
 import unittest
 from collections import deque
-from datetime import datetime, date
+from datetime import datetime, date, timezone
 from ipaddress import ip_address
 from typing import cast
 
@@ -45,11 +45,20 @@ class TestDAO(unittest.TestCase):
         self.dao = DAO(self.db)
 
     def tearDown(self) -> None:
+        self.dao.close()
         self.db.close()
 
     def test_database_size(self) -> None:
         self.assertEqual(0, self.dao.size())
 
+    def test_configure(self) -> None:
+        settings = "SELECT current_setting('preserve_insertion_order'), current_setting('threads')"
+
+        self.assertFalse(self.dao.run(settings)[0][0])
+
+        self.dao.configure(preserve_order=True, threads=1, memory_limit='1GB')
+        self.assertEqual([True, 1], list(self.dao.run(settings)[0]))
+
     def test_create_and_drop_table(self) -> None:
         table1 = __name__ + '_1'
         table2 = __name__ + '_2'
@@ -88,6 +97,18 @@ class TestDAO(unittest.TestCase):
 
         self.assertEqual(self.ENTRIES, entries)
 
+    def test_batch_insert_into_with_cursor(self) -> None:
+        table = __name__
+
+        self.seed(table, insert_entries=False)
+
+        with self.dao.transaction() as cursor:
+            count = self.dao.batch_insert_into(table, self.ENTRIES, cursor=cursor, chunk_size=3)
+            self.assertEqual(len(self.ENTRIES), count)
+
+        entries = self.dao.select(table)
+        self.assertEqual(self.ENTRIES, entries)
+
     def test_batch_insert_into_from_deque_and_select(self) -> None:
         table = __name__
 
@@ -104,6 +125,26 @@ class TestDAO(unittest.TestCase):
         entries = self.dao.select(table)
         self.assertEqual(self.ENTRIES, entries)
 
+    def test_batch_insert_into_from_deque_error(self) -> None:
+        entries_deque = deque(self.ENTRIES)
+
+        with self.assertRaises(duckdb.Error):
+            self.dao.batch_insert_into_from_deque(__name__, entries_deque)
+
+        self.assertEqual(self.ENTRIES, list(entries_deque))
+
+    def test_batch_append_and_select(self) -> None:
+        table = __name__
+
+        self.seed(table, insert_entries=False)
+        self.assertEqual(0, self.dao.batch_append(table, []))
+
+        count = self.dao.batch_append(table, self.ENTRIES, chunk_size=3)
+        self.assertEqual(len(self.ENTRIES), count)
+
+        entries = self.dao.select(table)
+        self.assertEqual(self.ENTRIES, entries)
+
     def test_select(self) -> None:
         table = __name__
 
@@ -124,6 +165,15 @@ class TestDAO(unittest.TestCase):
         after = self.dao.select(table, start=date(2020, 1, 2))
         self.assertEqual(self.ENTRIES_20200102, after)
 
+        until_max = self.dao.select(table, stop=date.max)
+        self.assertEqual(self.ENTRIES, until_max)
+
+        after_max = self.dao.select(table, start=date.max, stop=date.max)
+        self.assertEqual([], after_max)
+
+        limited = self.dao.select(table, start=date(2020, 1, 1), limit=1)
+        self.assertEqual(self.ENTRIES[:1], limited)
+
     def test_select_average(self) -> None:
         table = __name__
 
@@ -169,6 +219,17 @@ class TestDAO(unittest.TestCase):
         self.assertEqual(0.505, after.elements[0].avg)
         self.assertEqual(len(self.ENTRIES_20200102), after.elements[0].count)
 
+    def test_select_unknown_field(self) -> None:
+        table = __name__
+
+        self.seed(table)
+
+        with self.assertRaises(ValueError):
+            self.dao.select_average(table, 'generation_time; DROP TABLE users')
+
+        with self.assertRaises(ValueError):
+            self.dao.select_count(table, 'unknown')
+
     def test_select_count(self) -> None:
         table = __name__
 
@@ -285,10 +346,62 @@ class TestDAO(unittest.TestCase):
         self.assertEqual(date(2020, 1, 2), after.elements[0].date)
         self.assertEqual(2, after.elements[0].count)
 
+        limited = self.dao.select_count_group(table, 'ip', 'platform_name', start=date(2020, 1, 1), limit=1)
+        self.assertEqual(2, len(limited.elements))
+        self.assertEqual(date(2020, 1, 1), limited.elements[0].date)
+        self.assertEqual(date(2020, 1, 2), limited.elements[1].date)
+        self.assertEqual(2, limited.elements[1].count)
+
+    def test_shared_cursor(self) -> None:
+        with self.dao.cursor() as cursor:
+            pass
+
+        with self.dao.transaction() as other:
+            self.assertIs(cursor, other)
+
+    def test_nested_transaction(self) -> None:
+        table = __name__
+
+        self.seed(table, insert_entries=False)
+
+        with self.dao.transaction() as cursor:
+            self.assertTrue(self.dao.table_exists(table))
+            self.assertEqual([table], self.dao.tables())
+
+            self.dao.insert_into(table, self.ENTRIES[0])
+            self.dao.batch_insert_into(table, self.ENTRIES[1:], cursor=cursor)
+
+            with self.dao.cursor() as other:
+                self.assertIsNot(cursor, other)
+
+        self.assertEqual(self.ENTRIES, self.dao.select(table))
+
+    def test_run_isolated(self) -> None:
+        table = __name__
+
+        self.seed(table, insert_entries=False)
+
+        self.dao.run("SET TimeZone = 'Asia/Tokyo'")
+        self.dao.run("ATTACH ':memory:' AS other; USE other")
+
+        entry = self.ENTRIES[0]._replace(datetime=datetime(2020, 1, 1, 23, 30, tzinfo=timezone.utc))
+
+        self.dao.insert_into(table, entry)
+        self.dao.batch_insert_into(table, [entry])
+
+        entries = self.dao.select(table)
+        self.assertEqual([datetime(2020, 1, 1, 23, 30)] * 2, [current.datetime for current in entries])
+
     def test_error(self) -> None:
         with self.assertRaises(duckdb.Error):
             self.dao.run('SELECT UNSELECT;')
 
+        with self.assertRaises(duckdb.Error):
+            with self.dao.transaction() as cursor:
+                cursor.execute('SELECT UNSELECT;')
+
+        self.assertEqual(0, self.dao.size())
+
     def seed(self, table: str, create_table: bool = True, insert_entries: bool = True) -> None:
         if create_table:
             self.assertFalse(self.dao.table_exists(table))